@@ -0,0 +1,863 @@
+"""Self-hosted embedding sidecar for Code-Warden.
+
+Serves a HuggingFace sentence-embedding model (nomic-embed-text by default)
+behind a small FastAPI app. Intended to run next to the main Go server for
+bulk indexing workloads where the Ollama embedding path is the bottleneck.
+
+Endpoints:
+    POST /embed   {"texts": [...], "task": "search_document"} -> {"embeddings": [[...]]}
+    GET  /health  liveness probe
+
+Configuration is via environment variables (EMBEDDER_* prefix), matching the
+ai.embedder_* settings in config.yaml.
+"""
+
+import asyncio
+import logging
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+# Must be set before transformers is imported for the Rust tokenizer to
+# parallelize batch encoding.
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "true")
+
+import torch
+import torch.nn.functional as F
+from torch.nn.attention import SDPBackend, sdpa_kernel
+from fastapi import FastAPI, HTTPException, Query, Response
+from pydantic import BaseModel, Field
+from transformers import AutoModel, AutoTokenizer
+
+try:
+    import orjson
+except ImportError:  # fall back to Pydantic's default JSON encoder
+    orjson = None
+
+try:
+    from blake3 import blake3 as _digest
+except ImportError:  # blake3 is optional; xxhash and sha256 hash slower
+    try:
+        from xxhash import xxh3_128 as _digest
+    except ImportError:
+        from hashlib import sha256 as _digest
+
+MODEL_NAME = os.getenv("EMBEDDER_MODEL", "nomic-ai/nomic-embed-text-v1.5")
+# Truncation ceiling only — batches are padded to their own longest item, so
+# this never inflates the padded width. When unset, it is derived from the
+# tokenizer's model_max_length at load (capped, since some tokenizers report
+# a sentinel "unlimited" value).
+_MAX_LENGTH_ENV = os.getenv("EMBEDDER_MAX_LENGTH")
+MAX_LENGTH = int(_MAX_LENGTH_ENV) if _MAX_LENGTH_ENV else 2048
+MAX_LENGTH_CAP = 8192
+# Upper bound on padded tokens (batch_size * longest_item) per forward pass.
+TOKEN_BUDGET = int(os.getenv("EMBEDDER_TOKEN_BUDGET", "32768"))
+COMPILE = os.getenv("EMBEDDER_COMPILE", "1") == "1"
+# Sequence lengths are padded up to a multiple of this so torch.compile sees a
+# small, bounded set of shapes instead of recompiling per request.
+PAD_MULTIPLE = 64
+# Explicit CUDA graph capture for the eager path. torch.compile's
+# reduce-overhead mode already replays its own graphs, so this only kicks in
+# when compilation is disabled.
+CUDA_GRAPHS = os.getenv("EMBEDDER_CUDA_GRAPHS", "1") == "1"
+# Variable-length attention over jagged nested tensors; probed at startup and
+# silently disabled when the model's forward rejects nested inputs.
+JAGGED = os.getenv("EMBEDDER_JAGGED", "1") == "1"
+GRAPH_BATCH = int(os.getenv("EMBEDDER_GRAPH_BATCH", "8"))
+GRAPH_LENGTHS = (128, 256, 512, 1024, 2048)
+# Prefer the fused attention kernels; the math backend is the slow fallback.
+SDPA_BACKENDS = [SDPBackend.FLASH_ATTENTION, SDPBackend.EFFICIENT_ATTENTION]
+# Server-side micro-batching: how long the batcher waits to accumulate more
+# items once the first one arrives, and the queue's back-pressure bound.
+MAX_WAIT_MS = float(os.getenv("EMBEDDER_MAX_WAIT_MS", "5"))
+QUEUE_SIZE = int(os.getenv("EMBEDDER_QUEUE_SIZE", "4096"))
+# Cap on how many items one coalesced group may hold; keeps worst-case
+# latency for the first caller bounded independently of the queue depth.
+MAX_COALESCE = int(os.getenv("EMBEDDER_MAX_COALESCE", "256"))
+# In-process LRU of normalized embeddings keyed by content hash; incremental
+# indexing re-sends mostly unchanged snippets, which now skip the GPU. 0 disables.
+CACHE_SIZE = int(os.getenv("EMBEDDER_CACHE_SIZE", "100000"))
+# INT8 for the FFN linear layers only; attention and LayerNorm stay in
+# BF16/FP16. Guarded by a cosine check against the unquantized model and a
+# kill-switch, and skipped entirely when bitsandbytes is unavailable.
+QUANTIZE_FFN = os.getenv("EMBEDDER_QUANTIZE_FFN", "1") == "1"
+QUANTIZE_MIN_COSINE = 0.995
+# Representative snippets for post-quantization fidelity validation.
+_VALIDATION_SAMPLES = [
+    "func main() {\n\tfmt.Println(\"hello\")\n}",
+    "def fibonacci(n):\n    return n if n < 2 else fibonacci(n - 1) + fibonacci(n - 2)",
+    "SELECT id, name FROM users WHERE created_at > now() - interval '7 days';",
+]
+
+logging.basicConfig(level=os.getenv("EMBEDDER_LOG_LEVEL", "INFO"))
+logger = logging.getLogger("embedder")
+
+state: dict = {}
+
+
+def _load_model_sync() -> None:
+    """Load tokenizer and model; called once from lifespan on a worker thread."""
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    logger.info("loading model %s on %s", MODEL_NAME, device)
+
+    if device.type == "cuda":
+        # BF16 keeps the FP32 exponent range, so no overflow fallback is
+        # needed; same tensor-core throughput as FP16 on Ampere and newer.
+        dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+    else:
+        dtype = torch.float32
+
+    tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME, trust_remote_code=True, use_fast=True)
+
+    global MAX_LENGTH
+    if _MAX_LENGTH_ENV is None:
+        model_max = getattr(tokenizer, "model_max_length", 0)
+        if 0 < model_max <= MAX_LENGTH_CAP:
+            MAX_LENGTH = model_max
+        elif model_max > MAX_LENGTH_CAP:
+            MAX_LENGTH = MAX_LENGTH_CAP
+        logger.info("truncation ceiling set to %d tokens", MAX_LENGTH)
+
+    if device.type == "cpu":
+        model = _load_openvino_model()
+        if model is not None:
+            state["tokenizer"] = tokenizer
+            state["model"] = model
+            state["device"] = device
+            state["dtype"] = dtype
+            state["hidden"] = model.config.hidden_size
+            state["backend"] = "openvino"
+            logger.info("model ready (OpenVINO CPU backend)")
+            return
+
+    try:
+        # SDPA routes attention through the fused flash/mem-efficient kernels,
+        # cutting HBM traffic on the O(T^2) step that dominates long snippets.
+        model = AutoModel.from_pretrained(
+            MODEL_NAME,
+            trust_remote_code=True,
+            torch_dtype=dtype,
+            attn_implementation="sdpa",
+        )
+    except ValueError:
+        logger.warning("model %s does not support sdpa attention, using default", MODEL_NAME)
+        model = AutoModel.from_pretrained(
+            MODEL_NAME,
+            trust_remote_code=True,
+            torch_dtype=dtype,
+        )
+    model.to(device)
+    model.eval()
+
+    state["tokenizer"] = tokenizer
+    state["model"] = model
+    state["device"] = device
+    state["dtype"] = dtype
+    state["hidden"] = model.config.hidden_size
+    state["backend"] = "torch"
+    if device.type == "cuda":
+        # Dedicated stream for device-to-host result copies so they can
+        # overlap with the next batch's compute on the default stream.
+        state["copy_stream"] = torch.cuda.Stream()
+    logger.info("model ready")
+
+
+def _load_openvino_model():
+    """CPU tier: serve through OpenVINO's BF16 runtime when available.
+
+    A plain FP16/FP32 PyTorch forward is slow on CPU; the OpenVINO runtime
+    with a BF16 precision hint makes cheap CPU replicas viable for the
+    low-QPS query path. INT8 is deliberately not used here — it costs
+    embedding fidelity on this model class. Returns None when optimum-intel
+    is not installed, falling back to eager PyTorch.
+    """
+    try:
+        from optimum.intel import OVModelForFeatureExtraction
+    except ImportError:
+        logger.warning("optimum-intel not installed; using eager PyTorch on CPU")
+        return None
+    return OVModelForFeatureExtraction.from_pretrained(
+        MODEL_NAME,
+        export=True,
+        trust_remote_code=True,
+        ov_config={"INFERENCE_PRECISION_HINT": "bf16"},
+    )
+
+
+def _embed_validation_samples() -> torch.Tensor:
+    """Embed the validation snippets through the current model."""
+    seqs = _tokenize_items(_VALIDATION_SAMPLES, ["search_document"] * len(_VALIDATION_SAMPLES))
+    dest = torch.empty(
+        (len(_VALIDATION_SAMPLES), state["hidden"]),
+        dtype=torch.float32,
+        pin_memory=state["device"].type == "cuda",
+    )
+    out, event = _encode_batch(seqs, dest)
+    if event is not None:
+        event.synchronize()
+    return out.clone()
+
+
+def _is_ffn_linear(full_name: str) -> bool:
+    # BERT-style FFN projections; attention.output.dense must stay excluded.
+    if ".attention." in full_name or ".attn." in full_name:
+        return False
+    return full_name.endswith(("intermediate.dense", "output.dense", "mlp.fc1", "mlp.fc2"))
+
+
+def _quantize_ffn_sync() -> None:
+    """Replace FFN linear layers with INT8, keeping attention in BF16/FP16.
+
+    The FFN matmuls dominate the encoder's FLOPs and tolerate INT8; full-model
+    INT8 hurts embedding fidelity, so attention and LayerNorm keep their
+    dtype. The swap is validated against the unquantized model on sample
+    snippets and reverted wholesale if cosine similarity drops.
+    """
+    device = state["device"]
+    if not QUANTIZE_FFN or device.type != "cuda":
+        return
+    try:
+        import bitsandbytes as bnb
+    except ImportError:
+        logger.warning("bitsandbytes not installed; skipping FFN quantization")
+        return
+
+    model = state["model"]
+    baseline = _embed_validation_samples()
+
+    replaced: list[tuple[torch.nn.Module, str, torch.nn.Linear]] = []
+    for parent_name, parent in model.named_modules():
+        for child_name, child in parent.named_children():
+            full_name = f"{parent_name}.{child_name}" if parent_name else child_name
+            if not isinstance(child, torch.nn.Linear) or not _is_ffn_linear(full_name):
+                continue
+            int8_linear = bnb.nn.Linear8bitLt(
+                child.in_features,
+                child.out_features,
+                bias=child.bias is not None,
+                has_fp16_weights=False,
+                threshold=6.0,
+            )
+            int8_linear.load_state_dict(child.state_dict())
+            int8_linear.to(device)
+            setattr(parent, child_name, int8_linear)
+            replaced.append((parent, child_name, child))
+    if not replaced:
+        logger.warning("no FFN linear layers matched; model left unquantized")
+        return
+
+    try:
+        quantized = _embed_validation_samples()
+        cosine = F.cosine_similarity(baseline, quantized, dim=1).min().item()
+    except Exception as exc:  # noqa: BLE001 - validate-and-revert must not kill startup
+        for parent, child_name, original in replaced:
+            setattr(parent, child_name, original)
+        logger.warning(
+            "FFN INT8 validation forward failed (%s: %s); reverted to full precision",
+            type(exc).__name__,
+            exc,
+        )
+        return
+    if cosine < QUANTIZE_MIN_COSINE:
+        for parent, child_name, original in replaced:
+            setattr(parent, child_name, original)
+        logger.warning(
+            "FFN INT8 cosine %.4f below %.3f; reverted to full precision",
+            cosine,
+            QUANTIZE_MIN_COSINE,
+        )
+        return
+    logger.info("quantized %d FFN layers to INT8 (min cosine %.4f)", len(replaced), cosine)
+
+
+def _compile_sync() -> None:
+    """Wrap the (possibly quantized) model in torch.compile."""
+    if COMPILE and state["device"].type == "cuda":
+        state["model"] = torch.compile(
+            state["model"], mode="reduce-overhead", dynamic=True, fullgraph=False
+        )
+
+
+def _warmup_sync() -> None:
+    """Run a few representative shapes so compilation happens before traffic."""
+    if not (COMPILE and state["device"].type == "cuda"):
+        return
+    for batch_size, words in ((1, 16), (4, 64), (8, 256)):
+        seqs = _tokenize_items(["code " * words] * batch_size, ["search_document"] * batch_size)
+        dest = torch.empty((batch_size, state["hidden"]), dtype=torch.float32, pin_memory=True)
+        _, event = _encode_batch(seqs, dest)
+        if event is not None:
+            event.synchronize()
+    logger.info("compile warmup done")
+
+
+def _capture_graphs_sync() -> None:
+    """Capture one CUDA graph per sequence-length bucket at fixed batch size.
+
+    Each bucket owns static (GRAPH_BATCH, T) input buffers and the captured
+    forward's output buffer; the batch loop copies ids/mask in and replays,
+    so steady-state batches pay no Python dispatch or kernel-launch cost.
+    """
+    device = state["device"]
+    if not CUDA_GRAPHS or COMPILE or device.type != "cuda":
+        return
+    model = state["model"]
+    dtype = state["dtype"]
+    graphs = {}
+    for seq_len in GRAPH_LENGTHS:
+        if seq_len > MAX_LENGTH:
+            break
+        try:
+            static_ids = torch.zeros((GRAPH_BATCH, seq_len), dtype=torch.long, device=device)
+            static_mask = torch.ones((GRAPH_BATCH, seq_len), dtype=torch.long, device=device)
+            with (
+                torch.inference_mode(),
+                torch.autocast(device_type="cuda", dtype=dtype),
+                sdpa_kernel(SDPA_BACKENDS),
+            ):
+                for _ in range(3):  # warm up allocator and autotuner before capture
+                    model(input_ids=static_ids, attention_mask=static_mask)
+                torch.cuda.synchronize()
+                graph = torch.cuda.CUDAGraph()
+                with torch.cuda.graph(graph):
+                    static_out = model(input_ids=static_ids, attention_mask=static_mask)[0]
+        except Exception as exc:  # noqa: BLE001 - not graph-capturable; keep eager
+            # Remote-code encoders with data-dependent control flow cannot be
+            # captured; serve those buckets through the regular forward.
+            logger.info(
+                "CUDA graph capture failed for T=%d (%s); keeping eager path",
+                seq_len,
+                type(exc).__name__,
+            )
+            torch.cuda.synchronize()
+            continue
+        graphs[seq_len] = (graph, static_ids, static_mask, static_out)
+    state["graphs"] = graphs
+    logger.info("captured CUDA graphs for T in %s", sorted(graphs))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, _load_model_sync)
+    await loop.run_in_executor(None, _quantize_ffn_sync)
+    await loop.run_in_executor(None, _compile_sync)
+    await loop.run_in_executor(None, _warmup_sync)
+    await loop.run_in_executor(None, _probe_jagged_sync)
+    await loop.run_in_executor(None, _capture_graphs_sync)
+
+    # Single GPU worker thread: all forwards are serialized off the event
+    # loop, and concurrent requests share server-side batches via the queue.
+    state["gpu_pool"] = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gpu")
+    state["tok_pool"] = ThreadPoolExecutor(max_workers=2, thread_name_prefix="tok")
+    state["pending"] = asyncio.Queue(maxsize=QUEUE_SIZE)
+    # 1-deep hand-off between the tokenize and GPU stages: group k+1
+    # tokenizes while group k is on the GPU, without unbounded buffering.
+    state["ready"] = asyncio.Queue(maxsize=1)
+    state["cache"] = OrderedDict()
+    stage_tasks = [
+        asyncio.create_task(_tokenizer_loop()),
+        asyncio.create_task(_gpu_loop()),
+    ]
+    yield
+    for task in stage_tasks:
+        task.cancel()
+    state["gpu_pool"].shutdown(wait=False)
+    state["tok_pool"].shutdown(wait=False)
+    state.clear()
+
+
+app = FastAPI(title="code-warden-embedder", lifespan=lifespan)
+
+
+class EmbedRequest(BaseModel):
+    texts: list[str] = Field(..., min_length=1)
+    task: str = "search_document"
+
+
+class EmbedResponse(BaseModel):
+    embeddings: list[list[float]]
+    count: int
+    model: str
+
+
+def mean_pooling(token_embeddings, attention_mask):
+    """Mask-aware mean over token embeddings.
+
+    The masked sum is a single einsum reduction instead of materializing a
+    (B, T, H) expanded mask and chaining multiply/sum/clamp/divide kernels.
+    Stays in the model dtype; the caller upcasts for the final normalize.
+    """
+    mask = attention_mask.to(token_embeddings.dtype)
+    sums = torch.einsum("bth,bt->bh", token_embeddings, mask)
+    counts = mask.sum(dim=1, keepdim=True).clamp_min(1)
+    return sums / counts
+
+
+def _pack_batches(lengths: list[int]) -> list[list[int]]:
+    """Group item indices into batches under TOKEN_BUDGET padded tokens.
+
+    Items are sorted by tokenized length so each batch holds similar-length
+    texts; the padded cost of a batch is len(batch) * longest_item, so mixing
+    one long snippet into a batch of short ones no longer pads everything to
+    the long one's length.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    batches: list[list[int]] = []
+    batch: list[int] = []
+    batch_max = 0
+    for idx in order:
+        item_len = lengths[idx]
+        new_max = max(batch_max, item_len)
+        if batch and (len(batch) + 1) * new_max > TOKEN_BUDGET:
+            batches.append(batch)
+            batch = []
+            new_max = item_len
+        batch.append(idx)
+        batch_max = new_max
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _ones_mask(batch: int, seq_len: int) -> torch.Tensor:
+    """Cached all-ones attention mask on device for fully packed batches.
+
+    Keyed by padded seq_len only — one tensor per length bucket, sliced to
+    the rows needed — so the cache is bounded by MAX_LENGTH / PAD_MULTIPLE
+    entries. Rows are sized to the largest batch the token budget permits at
+    this length (growing on demand), keeping the bound small in bytes too:
+    a long bucket only ever packs a handful of rows.
+    """
+    cache = state.setdefault("mask_cache", {})
+    mask = cache.get(seq_len)
+    if mask is None or mask.shape[0] < batch:
+        rows = max(batch, min(MAX_COALESCE, TOKEN_BUDGET // seq_len))
+        mask = torch.ones((rows, seq_len), dtype=torch.long, device=state["device"])
+        cache[seq_len] = mask
+    return mask[:batch]
+
+
+def _cache_key(task: str, text: str) -> bytes:
+    return _digest(f"{task}|{text}".encode()).digest()
+
+
+def _cache_put(cache: OrderedDict, key: bytes, row: torch.Tensor) -> None:
+    """Insert an embedding row and evict least-recently-used past CACHE_SIZE.
+
+    The row is cloned so the cache owns its storage; resolved rows are views
+    into a group's pinned output matrix, and caching the view would keep that
+    whole allocation alive.
+    """
+    cache[key] = row.clone()
+    cache.move_to_end(key)
+    while len(cache) > CACHE_SIZE:
+        cache.popitem(last=False)
+
+
+def _prefix_ids(task: str) -> list[int]:
+    """Token ids for a task prefix, encoded once per task and cached."""
+    cache = state.setdefault("prefix_ids", {})
+    ids = cache.get(task)
+    if ids is None:
+        ids = state["tokenizer"].encode(f"{task}: ", add_special_tokens=False)
+        cache[task] = ids
+    return ids
+
+
+def _tokenize_items(texts: list[str], tasks: list[str]) -> list[list[int]]:
+    """Tokenize raw texts once and prepend cached per-task prefix ids.
+
+    Prefixing at the id level avoids building a prefixed Python string per
+    item and re-tokenizing the same prefix on every call.
+    """
+    tokenizer = state["tokenizer"]
+    encoded = tokenizer(
+        texts,
+        add_special_tokens=False,
+        truncation=True,
+        max_length=MAX_LENGTH,
+    )
+    specials = tokenizer.num_special_tokens_to_add(pair=False)
+    seqs = []
+    for ids, task in zip(encoded["input_ids"], tasks):
+        prefix = _prefix_ids(task)
+        body = ids[: MAX_LENGTH - len(prefix) - specials]
+        seqs.append(tokenizer.build_inputs_with_special_tokens(prefix + body))
+    return seqs
+
+
+def _encode_batch(
+    seqs: list[list[int]], dest: torch.Tensor
+) -> tuple[torch.Tensor, "torch.cuda.Event | None"]:
+    """Pad and run one batch of tokenized items.
+
+    Normalized FP32 rows are written into ``dest``, a host-side slice of the
+    caller's preallocated output matrix, so no per-batch result tensors are
+    allocated and no final concatenation is needed. On CUDA the returned
+    event fences the in-flight result copy; see _store_result.
+    """
+    tokenizer = state["tokenizer"]
+    model = state["model"]
+    device = state["device"]
+    dtype = state["dtype"]
+
+    if state.get("jagged") and len({len(s) for s in seqs}) > 1:
+        # Mixed lengths mean real padding waste; attention over the jagged
+        # layout only touches real tokens.
+        return _encode_batch_jagged(seqs, dest)
+
+    encoded_input = tokenizer.pad(
+        {"input_ids": seqs},
+        padding="longest",
+        pad_to_multiple_of=PAD_MULTIPLE,
+        return_tensors="pt",
+    )
+    # Nomic-style encoders ignore segment ids; shipping them would cost an
+    # extra H2D copy and an embedding lookup per batch.
+    encoded_input.pop("token_type_ids", None)
+    if device.type == "cuda":
+        # Pinned staging lets the H2D copy run asynchronously on the stream.
+        mask = encoded_input["attention_mask"]
+        encoded_input = {
+            "input_ids": encoded_input["input_ids"].pin_memory().to(device, non_blocking=True),
+            # Batches packed to a uniform length need no per-batch mask
+            # transfer at all; a cached all-ones mask is reused.
+            "attention_mask": _ones_mask(*mask.shape)
+            if bool(mask.all())
+            else mask.pin_memory().to(device, non_blocking=True),
+        }
+    else:
+        encoded_input = dict(encoded_input.to(device))
+
+    attention_mask = encoded_input["attention_mask"]
+    batch_size, seq_len = encoded_input["input_ids"].shape
+    graphs = state.get("graphs") or {}
+    bucket = next((t for t in GRAPH_LENGTHS if t in graphs and t >= seq_len), None)
+
+    if bucket is not None and batch_size <= GRAPH_BATCH:
+        graph, static_ids, static_mask, static_out = graphs[bucket]
+        static_ids.zero_()
+        static_mask.zero_()
+        static_ids[:batch_size, :seq_len].copy_(encoded_input["input_ids"])
+        static_mask[:batch_size, :seq_len].copy_(attention_mask)
+        graph.replay()
+        token_embeddings = static_out[:batch_size, :seq_len]
+    elif device.type == "cuda":
+        with (
+            torch.inference_mode(),
+            torch.autocast(device_type="cuda", dtype=dtype),
+            sdpa_kernel(SDPA_BACKENDS),
+        ):
+            token_embeddings = model(**encoded_input)[0]
+    else:
+        with torch.inference_mode():
+            token_embeddings = model(**encoded_input)[0]
+
+    embeddings = mean_pooling(token_embeddings, attention_mask)
+    return _store_result(embeddings, dest)
+
+
+def _encode_batch_jagged(
+    seqs: list[list[int]], dest: torch.Tensor
+) -> tuple[torch.Tensor, "torch.cuda.Event | None"]:
+    """Run a mixed-length batch as a jagged nested tensor — no padding at all.
+
+    Attention via the SDPA path computes only over real tokens, so the
+    O(T^2) cost tracks each item's own length instead of the batch maximum.
+    Every token is real, which makes the plain mean over the ragged
+    dimension equivalent to masked mean pooling.
+    """
+    model = state["model"]
+    dtype = state["dtype"]
+    nested_ids = torch.nested.nested_tensor(
+        [torch.tensor(s, dtype=torch.long) for s in seqs],
+        layout=torch.jagged,
+        device=state["device"],
+    )
+    with (
+        torch.inference_mode(),
+        torch.autocast(device_type="cuda", dtype=dtype),
+        sdpa_kernel(SDPA_BACKENDS),
+    ):
+        token_embeddings = model(input_ids=nested_ids)[0]
+    return _store_result(token_embeddings.mean(dim=1), dest)
+
+
+def _probe_jagged_sync() -> None:
+    """Check once whether the model accepts jagged nested inputs.
+
+    Most remote-code model implementations reject nested tensors; when the
+    probe fails the server keeps the bucket-padded path.
+    """
+    state["jagged"] = False
+    if not JAGGED or state["device"].type != "cuda":
+        return
+    try:
+        seqs = _tokenize_items(["x", "y " * 32], ["search_document"] * 2)
+        dest = torch.empty((2, state["hidden"]), dtype=torch.float32, pin_memory=True)
+        _, event = _encode_batch_jagged(seqs, dest)
+        if event is not None:
+            event.synchronize()
+    except Exception as exc:  # noqa: BLE001 - any failure means unsupported
+        logger.info(
+            "jagged nested inputs unsupported (%s); keeping padded batches",
+            type(exc).__name__,
+        )
+        return
+    state["jagged"] = True
+    logger.info("jagged nested inputs enabled for mixed-length batches")
+
+
+def _store_result(
+    embeddings: torch.Tensor, dest: torch.Tensor
+) -> tuple[torch.Tensor, "torch.cuda.Event | None"]:
+    """Normalize in FP32 and queue the copy into the host-side destination.
+
+    On CUDA the copy is only enqueued on the side stream and fenced with the
+    returned event — the caller must synchronize it before reading ``dest``.
+    Deferring that wait lets the GPU thread start the next batch's forward
+    while this copy drains.
+    """
+    normalized = F.normalize(embeddings.float(), p=2, dim=1)
+    if state["device"].type != "cuda":
+        dest.copy_(normalized)
+        return dest, None
+
+    copy_stream = state["copy_stream"]
+    copy_stream.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(copy_stream):
+        dest.copy_(normalized, non_blocking=True)
+    # The allocator frees blocks against the allocation stream; without this
+    # the next pack's forward could reuse normalized's memory before the
+    # cross-stream copy has executed.
+    normalized.record_stream(copy_stream)
+    done = torch.cuda.Event()
+    done.record(copy_stream)
+    return dest, done
+
+
+def _encode_halves(seqs: list[list[int]], dest: torch.Tensor) -> tuple[torch.Tensor, None]:
+    """Encode a batch as two recursive halves writing into slices of dest.
+
+    Child copy events are synchronized here, so split results are always
+    settled when this returns.
+    """
+    mid = len(seqs) // 2
+    _, first = _encode_resilient(seqs[:mid], dest.narrow(0, 0, mid))
+    _, second = _encode_resilient(seqs[mid:], dest.narrow(0, mid, len(seqs) - mid))
+    for event in (first, second):
+        if event is not None:
+            event.synchronize()
+    return dest, None
+
+
+def _encode_resilient(
+    seqs: list[list[int]], dest: torch.Tensor
+) -> tuple[torch.Tensor, "torch.cuda.Event | None"]:
+    """_encode_batch behind an adaptive memory governor; runs on the GPU thread.
+
+    Attention memory scales with B*T^2, so the governor tracks a ceiling on
+    that product: batches above it are split in halves before they run, and
+    an OOM halves the ceiling and retries the same batch through the split
+    path instead of degrading to one-by-one reprocessing. Splits recurse on
+    slices of ``dest``, so results land in place without concatenation.
+    """
+    max_len = max(len(s) for s in seqs)
+    cost = len(seqs) * max_len * max_len
+    ceiling = state.get("max_bt2")
+    if ceiling is not None and cost > ceiling and len(seqs) > 1:
+        return _encode_halves(seqs, dest)
+    try:
+        return _encode_batch(seqs, dest)
+    except torch.cuda.OutOfMemoryError:
+        # Only release cached blocks when we actually ran out of memory;
+        # doing so per batch would serialize the stream every iteration.
+        torch.cuda.empty_cache()
+        new_ceiling = max(cost // 2, max_len * max_len)
+        state["max_bt2"] = min(ceiling, new_ceiling) if ceiling is not None else new_ceiling
+        logger.warning(
+            "OOM at B*T^2=%d; lowering ceiling to %d", cost, state["max_bt2"]
+        )
+        if len(seqs) == 1:
+            raise  # a single item exceeds device memory; nothing left to split
+        return _encode_halves(seqs, dest)
+
+
+async def _tokenizer_loop() -> None:
+    """Stage 1: drain the pending queue into groups and tokenize them.
+
+    Items from concurrent requests are merged: once the first item arrives,
+    the stage lingers up to MAX_WAIT_MS to accumulate more, tokenizes the
+    group on the tokenizer pool and hands it to the GPU stage. Because the
+    hand-off queue is 1-deep, the next group's tokenization overlaps the
+    current group's forward passes.
+    """
+    loop = asyncio.get_running_loop()
+    pending: asyncio.Queue = state["pending"]
+    ready: asyncio.Queue = state["ready"]
+    while True:
+        item = await pending.get()
+        items: list[tuple[str, str, asyncio.Future]] = [item]
+        # Grab whatever is already queued before arming the linger timer; a
+        # backlogged queue should not pay per-item timeout bookkeeping.
+        while len(items) < MAX_COALESCE:
+            try:
+                items.append(pending.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        deadline = loop.time() + MAX_WAIT_MS / 1000.0
+        while len(items) < MAX_COALESCE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                items.append(await asyncio.wait_for(pending.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        texts = [text for text, _, _ in items]
+        tasks = [task for _, task, _ in items]
+        try:
+            seqs = await loop.run_in_executor(
+                state["tok_pool"], _tokenize_items, texts, tasks
+            )
+        except Exception as exc:  # noqa: BLE001 - propagate to the waiting requests
+            for _, _, item_future in items:
+                if not item_future.done():
+                    item_future.set_exception(exc)
+            continue
+        await ready.put((items, seqs))
+
+
+async def _finalize_pack(
+    items: list[tuple[str, str, asyncio.Future]],
+    batch_indices: list[int],
+    dest: torch.Tensor,
+    event: "torch.cuda.Event | None",
+) -> None:
+    """Wait for a pack's result copy to land, then resolve its futures."""
+    if event is not None:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, event.synchronize)
+    for offset, idx in enumerate(batch_indices):
+        item_future = items[idx][2]
+        if not item_future.done():
+            item_future.set_result(dest[offset])
+
+
+async def _gpu_loop() -> None:
+    """Stage 2: pack tokenized groups by length and run them on the GPU thread.
+
+    Packs are pipelined one deep: pack k+1 is submitted to the GPU thread
+    before pack k's copy event is awaited, so the result copy of one pack
+    drains behind the forward pass of the next.
+    """
+    loop = asyncio.get_running_loop()
+    ready: asyncio.Queue = state["ready"]
+    while True:
+        items, seqs = await ready.get()
+        try:
+            # One output matrix for the whole group; each pack writes its
+            # rows in place instead of allocating and concatenating.
+            out = torch.empty(
+                (len(items), state["hidden"]),
+                dtype=torch.float32,
+                pin_memory=state["device"].type == "cuda",
+            )
+            pos = 0
+            inflight: tuple[list[int], torch.Tensor, "torch.cuda.Event | None"] | None = None
+            for batch_indices in _pack_batches([len(s) for s in seqs]):
+                batch_seqs = [seqs[i] for i in batch_indices]
+                dest = out.narrow(0, pos, len(batch_indices))
+                pos += len(batch_indices)
+                encode_future = loop.run_in_executor(
+                    state["gpu_pool"], _encode_resilient, batch_seqs, dest
+                )
+                if inflight is not None:
+                    await _finalize_pack(items, *inflight)
+                    inflight = None
+                _, event = await encode_future
+                inflight = (batch_indices, dest, event)
+            if inflight is not None:
+                await _finalize_pack(items, *inflight)
+        except Exception as exc:  # noqa: BLE001 - propagate to the waiting requests
+            for _, _, item_future in items:
+                if not item_future.done():
+                    item_future.set_exception(exc)
+
+
+@app.post("/embed", response_model=None)
+async def embed(
+    req: EmbedRequest,
+    format: str = Query("json", pattern="^(json|bin)$"),
+) -> EmbedResponse | Response:
+    if "model" not in state:
+        raise HTTPException(status_code=503, detail="model not loaded")
+
+    loop = asyncio.get_running_loop()
+    pending: asyncio.Queue = state["pending"]
+    cache: OrderedDict = state["cache"]
+
+    rows: list[torch.Tensor | None] = [None] * len(req.texts)
+    misses: list[tuple[int, bytes, asyncio.Future]] = []
+    for i, text in enumerate(req.texts):
+        key = _cache_key(req.task, text)
+        cached = cache.get(key)
+        if cached is not None:
+            cache.move_to_end(key)
+            rows[i] = cached
+            continue
+        future = loop.create_future()
+        await pending.put((text, req.task, future))
+        misses.append((i, key, future))
+
+    if misses:
+        computed = await asyncio.gather(*[future for _, _, future in misses])
+        for (i, key, _), row in zip(misses, computed):
+            rows[i] = row
+            if CACHE_SIZE > 0:
+                _cache_put(cache, key, row)
+
+    final_embeddings = torch.stack(rows, dim=0)
+
+    if format == "bin":
+        # Raw little-endian float16 rows: 4-8x smaller than JSON floats and
+        # skips building millions of Python float objects for large requests.
+        count, dim = final_embeddings.shape
+        return Response(
+            content=final_embeddings.to(torch.float16).numpy().tobytes(),
+            media_type="application/octet-stream",
+            headers={
+                "X-Shape": f"{count},{dim}",
+                "X-Dtype": "float16",
+                "X-Model": MODEL_NAME,
+            },
+        )
+
+    if orjson is not None:
+        # Serialize straight from the numpy matrix: no tolist(), no millions
+        # of intermediate Python floats, no Pydantic validation pass.
+        return Response(
+            content=orjson.dumps(
+                {
+                    "embeddings": final_embeddings.numpy(),
+                    "count": len(req.texts),
+                    "model": MODEL_NAME,
+                },
+                option=orjson.OPT_SERIALIZE_NUMPY,
+            ),
+            media_type="application/json",
+        )
+
+    return EmbedResponse(
+        embeddings=final_embeddings.tolist(),
+        count=len(req.texts),
+        model=MODEL_NAME,
+    )
+
+
+@app.get("/health")
+async def health() -> dict:
+    return {"status": "ok" if "model" in state else "loading", "model": MODEL_NAME}
@@ -0,0 +1,152 @@
+"""Tests for the embedder's pure-Python invariants.
+
+These cover the batching, truncation, cache-eviction and coalescing logic
+that runs before anything touches a GPU or a real model; no model download
+is needed. Run from embedder/ with the requirements installed:
+
+    python -m pytest -q test_server.py
+"""
+
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+import server
+
+
+class FakeTokenizer:
+    """Whitespace tokenizer with a stable per-word vocabulary."""
+
+    def __init__(self):
+        self.vocab: dict[str, int] = {}
+
+    def _ids(self, text):
+        return [self.vocab.setdefault(word, len(self.vocab) + 10) for word in text.split()]
+
+    def encode(self, text, add_special_tokens=False):
+        return self._ids(text)
+
+    def __call__(self, texts, add_special_tokens=False, truncation=True, max_length=None):
+        return {"input_ids": [self._ids(t)[:max_length] for t in texts]}
+
+    def num_special_tokens_to_add(self, pair=False):
+        return 2
+
+    def build_inputs_with_special_tokens(self, ids):
+        return [1] + list(ids) + [2]
+
+
+# --- _pack_batches ----------------------------------------------------------
+
+
+def test_pack_batches_covers_every_index_once(monkeypatch):
+    monkeypatch.setattr(server, "TOKEN_BUDGET", 100)
+    lengths = [5, 50, 10, 90, 1, 30, 30]
+    batches = server._pack_batches(lengths)
+    flat = sorted(i for batch in batches for i in batch)
+    assert flat == list(range(len(lengths)))
+
+
+def test_pack_batches_respects_padded_budget(monkeypatch):
+    monkeypatch.setattr(server, "TOKEN_BUDGET", 64)
+    lengths = [3, 7, 15, 16, 17, 31, 32, 33, 60]
+    for batch in server._pack_batches(lengths):
+        padded = len(batch) * max(lengths[i] for i in batch)
+        assert padded <= 64 or len(batch) == 1
+
+
+def test_pack_batches_budget_boundary(monkeypatch):
+    # Four items of length 25 fit exactly in a 100-token budget; a fifth
+    # must start a new batch.
+    monkeypatch.setattr(server, "TOKEN_BUDGET", 100)
+    batches = server._pack_batches([25] * 5)
+    assert sorted(len(b) for b in batches) == [1, 4]
+
+
+def test_pack_batches_single_item_over_budget(monkeypatch):
+    monkeypatch.setattr(server, "TOKEN_BUDGET", 10)
+    batches = server._pack_batches([50, 50])
+    assert [len(b) for b in batches] == [1, 1]
+
+
+# --- _tokenize_items --------------------------------------------------------
+
+
+def test_tokenize_items_truncates_to_ceiling(monkeypatch):
+    monkeypatch.setattr(server, "MAX_LENGTH", 16)
+    monkeypatch.setitem(server.state, "tokenizer", FakeTokenizer())
+    monkeypatch.setitem(server.state, "prefix_ids", {})
+    texts = ["word " * 100, "short text"]
+    seqs = server._tokenize_items(texts, ["search_document"] * 2)
+    assert all(len(seq) <= 16 for seq in seqs)
+
+
+def test_tokenize_items_prepends_cached_prefix(monkeypatch):
+    monkeypatch.setattr(server, "MAX_LENGTH", 32)
+    tokenizer = FakeTokenizer()
+    monkeypatch.setitem(server.state, "tokenizer", tokenizer)
+    monkeypatch.setitem(server.state, "prefix_ids", {})
+    seqs = server._tokenize_items(["alpha beta"], ["search_document"])
+    prefix = tokenizer.encode("search_document: ", add_special_tokens=False)
+    # CLS, prefix ids, body, SEP
+    assert seqs[0][0] == 1
+    assert seqs[0][1 : 1 + len(prefix)] == prefix
+    assert seqs[0][-1] == 2
+    assert server.state["prefix_ids"]["search_document"] == prefix
+
+
+# --- _cache_put -------------------------------------------------------------
+
+
+def test_cache_put_evicts_least_recently_used(monkeypatch):
+    monkeypatch.setattr(server, "CACHE_SIZE", 3)
+    cache: OrderedDict = OrderedDict()
+    rows = {i: torch.full((4,), float(i)) for i in range(5)}
+    for i in range(5):
+        server._cache_put(cache, bytes([i]), rows[i])
+    assert len(cache) == 3
+    assert list(cache) == [bytes([2]), bytes([3]), bytes([4])]
+
+
+def test_cache_put_clones_the_row(monkeypatch):
+    monkeypatch.setattr(server, "CACHE_SIZE", 10)
+    cache: OrderedDict = OrderedDict()
+    matrix = torch.zeros((4, 8))
+    row = matrix[1]
+    server._cache_put(cache, b"k", row)
+    assert cache[b"k"].data_ptr() != matrix.data_ptr()
+    torch.testing.assert_close(cache[b"k"], row)
+
+
+# --- coalescing -------------------------------------------------------------
+
+
+def test_tokenizer_loop_caps_group_size(monkeypatch):
+    async def run():
+        monkeypatch.setattr(server, "MAX_COALESCE", 4)
+        monkeypatch.setattr(server, "MAX_WAIT_MS", 1.0)
+        monkeypatch.setattr(server, "MAX_LENGTH", 32)
+        monkeypatch.setitem(server.state, "tokenizer", FakeTokenizer())
+        monkeypatch.setitem(server.state, "prefix_ids", {})
+        monkeypatch.setitem(server.state, "pending", asyncio.Queue())
+        monkeypatch.setitem(server.state, "ready", asyncio.Queue(maxsize=1))
+        pool = ThreadPoolExecutor(max_workers=1)
+        monkeypatch.setitem(server.state, "tok_pool", pool)
+
+        loop = asyncio.get_running_loop()
+        for i in range(10):
+            server.state["pending"].put_nowait(
+                (f"text {i}", "search_document", loop.create_future())
+            )
+        stage = asyncio.create_task(server._tokenizer_loop())
+        try:
+            items, seqs = await asyncio.wait_for(server.state["ready"].get(), timeout=2)
+        finally:
+            stage.cancel()
+            pool.shutdown(wait=False)
+        assert len(items) == 4
+        assert len(seqs) == 4
+
+    asyncio.run(run())